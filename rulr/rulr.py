@@ -10,10 +10,16 @@ Options:
     -h             show help   
     -B Budget=30   when growing theory, how many labels?      
     -D Dull=0.01   when remaining mass dull, extend ranges 
+    -E Evals=0     anytime: max subsets to score (0=no limit)
     -F Few=64      sample size of data random sampling     
+    -L Length=4    max ranges in a beam rule
     -T Top=12      max number of subsets to explore 
+    -W Width=10    beam width (rules kept per rule length)
     -b bins=20     divisions of numerics (max-min)/b
     -d delta=0.35  Cohen's delta. ignore deltas less than d*sd
+    -e engine=py   compute backend: py (reference) or np (numpy)
+    -g grow=subsets rule generator: subsets (of Top ranges) or beam
+    -m msecs=0     anytime: stop scoring subsets after msecs (0=no limit)
     -p p=2         distance coeffecient   
     -r repeats=10  loop counter for rule generation
     -s seed=1701   random number seed      
@@ -21,7 +27,9 @@ Options:
    
 """
 from typing import Iterator, Iterable, Any
-import traceback, random, time, math, sys, re
+import traceback, random, time, math, sys, re, heapq, itertools
+try: import numpy as np
+except ImportError: np = None
    
 sys.dont_write_bytecode = True
    
@@ -53,32 +61,94 @@ def label(row:Row) -> Row:
   return row
 
 ### Constructors -----------------------------------------------------
-def Data(src:Iterable) -> o:
-  "Create a data from src."
+def Data(src:Iterable, syms=None) -> o:
+  "Create a data from src. Optionally, reuse some symbol codes."
   rows = iter(src)
-  cols = Cols(next(rows))
-  return o(cols = cols, 
+  cols = Cols(next(rows), syms)
+  data = o(cols = cols, 
            rows = shuffle([colsAdd(cols,row) for row in rows]))
+  data.index, data.bins = Index(data), the.bins
+  return data
 
 def clone(data:Data, rows=[]) -> o:
-  "Replicate sttucture of data. Optionally, add rows."
-  return Data([data.cols.names] + rows)
+  "Replicate sttucture of data (and its symbol codes). Optionally, add rows."
+  return Data([data.cols.names] + [decodeRow(data,row) for row in rows],
+              data.cols.syms)
 
-def Cols(lst : list[str]) -> o:
+def Cols(lst : list[str], syms=None) -> o:
   "From list of names, build the columns."
-  all = {c for c,s in enumerate(lst) if s[-1] != "X"}
-  y   = {c:lst[c][-1] != "-" for c in all if lst[c][-1] in "-+" }
+  all  = {c for c,s in enumerate(lst) if s[-1] != "X"}
+  y    = {c:lst[c][-1] != "-" for c in all if lst[c][-1] in "-+" }
+  nums = {c:(big,-big) for c in all if lst[c][0].isupper()}
   return o(
-    names = lst, all = all, y = y,
+    names = lst, all = all, y = y, nums = nums,
     x     = {c for c in all if c not in y},
-    nums  = {c:(big,-big) for c in all if lst[c][0].isupper()})
+    syms  = syms or {c:o(code={}, word=[]) for c in all if c not in nums})
 
 def colsAdd(cols:Cols, row:Row) -> Row:
-  "Update the colum summaries from row."
-  cols.nums = {c:(min(v,lo),max(v,hi)) 
-               for c,(lo,hi) in cols.nums.items() if (v:=row[c])!="?"}
+  "Update the colum summaries from row. Symbols are replaced by their codes."
+  cols.nums = {c:(lo,hi) if (v:=row[c])=="?" else (min(v,lo),max(v,hi))
+               for c,(lo,hi) in cols.nums.items()}
+  for c,sym in cols.syms.items():
+    if (v := row[c]) != "?":
+      if v not in sym.code: sym.code[v] = len(sym.word); sym.word += [v]
+      row[c] = sym.code[v]
   return row
 
+# Unseen symbols encode to codes that match nothing (not even each other).
+unseenRow, unseenRule = -1, -2
+
+def encodeRow(data:Data, row:Row) -> Row:
+  "Copy of a raw row, with symbols swapped for codes. Tables do not grow."
+  syms = data.cols.syms
+  return [syms[c].code.get(v, unseenRow) if c in syms and v != "?" else v
+          for c,v in enumerate(row)]
+
+def encodeRule(data:Data, rule:list) -> list:
+  "Copy of a decoded rule, with symbols swapped for codes. Tables do not grow."
+  syms = data.cols.syms
+  return [(s,name,x, tuple(syms[x].code.get(v, unseenRule) for v in span) 
+                     if x in syms else span)
+          for s,name,x,span in rule]
+
+def decodeRow(data:Data, row:Row) -> Row:
+  "Copy of row, with symbol codes swapped back to their original values."
+  syms = data.cols.syms
+  return [syms[c].word[v] if c in syms and v != "?" and v >= 0 else v 
+          for c,v in enumerate(row)]
+
+def decodeRule(data:Data, rule:list) -> list:
+  "Copy of rule, with symbol codes swapped back to their original values."
+  syms = data.cols.syms
+  word = lambda x,v: syms[x].word[v] if v >= 0 else v
+  return [(s,name,x, tuple(word(x,v) for v in span) if x in syms else span)
+          for s,name,x,span in rule]
+
+def Index(data:Data) -> dict:
+  """For numeric x columns, sorted distinct bins and the rank (in those bins)
+  of each value seen at load. Bins use the.bins (see reindex)."""
+  out = {}
+  for x in data.cols.x & data.cols.nums.keys():
+    lo,hi = data.cols.nums[x]
+    r     = (hi-lo)/the.bins + 1e-32
+    bins  = {v: int(v/r)*r for row in data.rows if (v:=row[x]) != "?"}
+    steps = sorted(set(bins.values()))
+    at    = {v:k for k,v in enumerate(steps)}
+    out[x] = o(steps = steps, rank = {v:at[b] for v,b in bins.items()})
+  return out
+
+def reindex(data:Data) -> dict:
+  "Return data.index, rebuilt if the.bins changed since it was built."
+  if data.bins != the.bins: data.index, data.bins = Index(data), the.bins
+  return data.index
+
+def ranks(data:Data, x:int, rows:Rows) -> list[int]:
+  "Ranks of rows' x values in the index (skipping unknowns)."
+  rank = data.index[x].rank
+  try: return [rank[v] for row in rows if (v:=row[x]) != "?"]
+  except KeyError as e: 
+    raise KeyError(f"{data.cols.names[x]}={e} not in index; Index(data)?")
+
 ### Range generation -------------------------------------------------
 def bestNum(name:str, x:int, good:list[Qty], bad:list[Qty]) -> tuple:
   "Find numeric range that best separates good from bad."
@@ -97,6 +167,30 @@ def bestNum(name:str, x:int, good:list[Qty], bad:list[Qty]) -> tuple:
         if delta > best: best, out = delta, (x1, x2)
   return round(best, 3), name, x, out
 
+def bestRank(name:str, x:int, steps:list[Qty], good:list[int], bad:list[int]):
+  "As bestNum, but on ranks into steps: counting replaces sorting and chops."
+  def below(ranks): # below(ranks)[k] = number of ranks < k
+    n = [0]*(len(steps) + 1)
+    for k in ranks: n[k+1] += 1
+    for k in range(len(steps)): n[k+1] += n[k]
+    return n
+  G, B       = below(good), below(bad)
+  A          = [g + b for g,b in zip(G,B)]
+  ks         = [k for k in range(len(steps)) if A[k+1] > A[k]]
+  sd         = stdev([steps[k] for k in ks for _ in range(A[k+1] - A[k])])
+  n, n1, n2  = A[-1], G[-1], B[-1]
+  best, out  = -1, None
+  for i in range(len(ks)):
+    for j in range(i+1, len(ks)):
+      x1, x2 = steps[ks[i]], steps[ks[j]]
+      if x2 - x1 >= the.delta * sd:
+        lo, hi = ks[i], ks[j] + 1
+        if A[lo]/n       < the.Dull: x1, lo = -big, 0
+        if (n - A[hi])/n < the.Dull: x2, hi =  big, len(steps)
+        delta = (G[hi] - G[lo])/n1 - (B[hi] - B[lo])/n2
+        if delta > best: best, out = delta, (x1, x2)
+  return round(best, 3), name, x, out
+
 def tail_extend(xs:list[Qty], x1:float, x2:float):
   "Extend x1,x2 to -inf,+inf if tails are below threshold."
   n = len(xs)
@@ -106,38 +200,78 @@ def tail_extend(xs:list[Qty], x1:float, x2:float):
   if right < the.Dull: x2 =  big
   return x1, x2
 
-def bestSym(name,x,dict1: dict[str,int], dict2: dict[str,int]): 
-  "Find the value that most selects for dict1 and least selects for dict2."
-  N     = sum(dict1.values()) + sum(dict2.values())
-  delta = lambda v: dict1.get(v,0)/N - dict2.get(v,0)/N
-  return max((round(delta(v),3),name,x,(v,v)) for v in dict1)
+def bestSym(name,x,counts1: dict[int,int], counts2: dict[int,int]): 
+  "Find the code that most selects for counts1 and least selects for counts2."
+  N     = sum(counts1.values()) + sum(counts2.values())
+  delta = lambda v: counts1.get(v,0)/N - counts2.get(v,0)/N
+  return max((round(delta(v),3),name,x,(v,v)) for v in counts1)
 
 ### Rule generation -------------------------------------------------
 def think(data: Data) -> Iterator[tuple]:
-  "Generate scored rules from labeled data."
-  best, rest = bestRest(data)
-  ranges = [makeRange(data, col, best, rest) for col in data.cols.x]
-  ranges = sorted(ranges)[-the.Top:]
-  print(ranges)
-  for rule in subsets(ranges):
-    yield score(rule, best, rest)
+  """Generate scored rules from labeled data, within the -m msecs and 
+  -E Evals budgets (if set). data.covered says how much was scored: evals
+  out of the space of all 2**Top-1 subsets or, for beam (a heuristic 
+  search, with no fixed space), the levels reached out of Length."""
+  t0 = time.time()
+  data.covered = o(evals=0, msecs=0)
+  try:
+    e = engine()
+    best, rest = bestRest(data)
+    ranges = sorted(e.makeRange(data, col, best, rest) for col in data.cols.x)
+    if the.grow == "beam": 
+      data.covered.update(levels=0, Length=the.Length)
+      yield from beam(e, data, ranges, best, rest, t0)
+    else:
+      ranges = ranges[-the.Top:]
+      print(decodeRule(data, ranges))
+      data.covered.space = 2**len(ranges) - 1
+      rules = promising(ranges) if the.msecs or the.Evals else subsets(ranges)
+      yield from budgeted(e, data, rules, best, rest, t0)
+  finally: data.covered.msecs = (time.time() - t0)*1000
+
+def spent(data:Data, t0:float) -> bool:
+  "True if this think() has used up its -E Evals or -m msecs."
+  return bool(the.Evals and data.covered.evals >= the.Evals or
+              the.msecs and (time.time() - t0)*1000 >= the.msecs)
+
+def budgeted(e:o, data:Data, rules:Iterable, best:Rows, rest:Rows, t0:float,
+             chunk=64) -> Iterator[tuple]:
+  "Score rules (in chunks, if budgeted) until they, or the budgets, run out."
+  rules = iter(rules)
+  while not spent(data, t0):
+    n = [k for k in (the.msecs and chunk, 
+                     the.Evals and the.Evals - data.covered.evals) if k]
+    if not (todo := list(itertools.islice(rules, min(n) if n else None))): break
+    data.covered.evals += len(todo)
+    yield from e.scores(todo, best, rest)
+
+def beam(e:o, data:Data, ranges:list, best:Rows, rest:Rows, 
+         t0:float) -> Iterator[tuple]:
+  "Grow rules one range at a time, keeping the Width best of each length."
+  ranges = [r for r in ranges if r[-1]]
+  rules  = [[]]
+  for _ in range(the.Length):
+    todo  = dict.fromkeys(tuple(sorted(rule + [r]))
+                          for rule in rules for r in ranges if r not in rule)
+    if not todo or spent(data, t0): break
+    data.covered.levels += 1
+    level = sorted(budgeted(e, data, [list(rule) for rule in todo], 
+                            best, rest, t0), reverse=True)
+    yield from level
+    rules = [rule for _,rule in level[:the.Width]]
 
 def makeRange(data:Data, x:int, best, rest) -> tuple:
   "Find discriminating range for column x."
-  def add(col,v):
-    if type(col) is dict: col[v] = 1 + col.get(v,0)
-    else: col += [int(v/r)*r]  # avoid spurious deltas
-
-  if x in data.cols.nums:
-     lo,hi = data.cols.nums[x]
-     r = (hi-lo)/the.bins + 1e-32
-     values1,values2= [],[]
-  else:
-     values1,values2= {},{}
-  [add(values1, v) for row in best if (v:=row[x]) != "?"]
-  [add(values2, v) for row in rest if (v:=row[x]) != "?"]
-  return (bestNum if x in data.cols.nums else bestSym)(
-          data.cols.names[x], x, values1, values2)
+  def counts(rows): # only the codes seen in rows, not the whole table
+    n = {}
+    for row in rows:
+      if (v:=row[x]) != "?": n[v] = 1 + n.get(v,0)
+    return n
+
+  if x in reindex(data):
+    return bestRank(data.cols.names[x], x, data.index[x].steps,
+                    ranks(data,x,best), ranks(data,x,rest))
+  return bestSym(data.cols.names[x], x, counts(best), counts(rest))
 
 def bestRest(data: Data) -> tuple[Rows,Rows]:
   "Return best and rest training groups."
@@ -148,13 +282,18 @@ def bestRest(data: Data) -> tuple[Rows,Rows]:
   return labeled[:cut], labeled[cut:]
 
 def score(rule:tuple, best:list, rest:list) -> float:
-  "Return harmonic mean of recall and false alarm."
+  "Return harmonic mean of recall and false alarm (0 if both are worst)."
   best1  = [row for row in best if selects(rule,row)]
   rest1  = [row for row in rest if selects(rule,row)]
   recall = len(best1) / len(best)
   pf     = len(rest1) / len(rest)
+  if recall + (1 - pf) == 0: return 0, rule
   return 2*recall*(1-pf) / (recall + (1 - pf)), rule
 
+def scores(rules:list, best:list, rest:list) -> Iterator[tuple]:
+  "Score each rule in turn."
+  for rule in rules: yield score(rule, best, rest)
+
 def selects(rule: tuple, row:Row) -> bool:
   "Returns true if rule selects for row."
   return all(select(row,x,lo,hi) for _,_,x,(lo,hi) in rule)
@@ -164,6 +303,127 @@ def select(row:Row, x:int, lo:Any, hi:Any) -> bool:
   if (v:=row[x])=="?": return True
   return lo <= v <= hi
 
+### Rule index ----------------------------------------------------
+# Which of many rules select a row? Rule sets are ints (bit n = rule n).
+# Per column, point ranges go in a dict and the others are cut into slots
+# (gaps and endpoints between their ends), each slot holding the rules
+# whose range covers it, plus the rules that do not test that column.
+# A row's rules are the AND, over columns, of its slots. Rules with two
+# ranges on one column ("odd") are just checked with selects.
+# Cost per row: one AND per column of bitsets len(rules) bits wide (i.e.
+# cols*len(rules)/64 machine words), plus decoding the matches. So this 
+# is a fast constant-factor scan, not a lookup that only touches matches.
+def RuleIndex(rules:list) -> o:
+  "Index rules by column, so row queries skip a scan over all rules."
+  idx  = o(rules=rules, some=0, cols={}, odd=[])
+  used = {}
+  for n,rule in enumerate(rules):
+    xs = [x for _,_,x,_ in rule]
+    if len(xs) > len(set(xs)): idx.odd += [n]; continue
+    idx.some |= 1 << n
+    for _,_,x,(lo,hi) in rule: 
+      used.setdefault(x, {})
+      used[x][(lo,hi)] = used[x].get((lo,hi), 0) | 1 << n
+  for x,spans in used.items():
+    ps    = sorted({p for lo,hi in spans for p in (lo,hi) if lo != hi})
+    slots = [idx.some & ~sum(spans.values())] * (2*len(ps) + 1)
+    for (lo,hi),rs in spans.items():
+      if lo == hi: continue
+      for i in range(2*chop(ps,lo) + 1, 2*chop(ps,hi) + 2): slots[i] |= rs
+    idx.cols[x] = o(ps=ps, slots=slots,
+                    eq={lo:rs for (lo,hi),rs in spans.items() if lo == hi})
+  return idx
+
+def cellRules(col:o, v:Atom) -> int:
+  "Rules (as a bitset) whose range on col selects the known value v."
+  i = chop(col.ps, v) if col.ps else 0
+  j = 2*i + 1 if i < len(col.ps) and col.ps[i] == v else 2*i
+  return col.slots[j] | col.eq.get(v, 0)
+
+def fires(idx:o, row:Row) -> list:
+  "Rules in idx that select row."
+  return firing(idx, [row])[0]
+
+def firing(idx:o, rows:Rows) -> list[list]:
+  """Rules that select each row. Goes column by column over all rows, so
+  rows sharing a value in a column share that column's lookup."""
+  rs = [idx.some] * len(rows)
+  for x,col in idx.cols.items():
+    seen = {}
+    for i,row in enumerate(rows):
+      if (v := row[x]) == "?": continue
+      if v not in seen: seen[v] = cellRules(col, v)
+      rs[i] &= seen[v]
+  out = []
+  for row,r in zip(rows, rs):
+    ns   = ones(r) + [n for n in idx.odd if selects(idx.rules[n], row)]
+    out += [[idx.rules[n] for n in (sorted(ns) if idx.odd else ns)]]
+  return out
+
+### NumPy engine ----------------------------------------------------
+# Same answers as the reference code above, computed with arrays.
+def npMakeRange(data:Data, x:int, best, rest) -> tuple:
+  "Find discriminating range for column x (via array counts)."
+  if x not in reindex(data):
+    def counts(rows): # only the codes seen in rows, not the whole table
+      vs = np.array([v for row in rows if (v:=row[x]) != "?"], int)
+      return dict(zip(*(a.tolist() for a in np.unique(vs, return_counts=True))))
+    return bestSym(data.cols.names[x], x, counts(best), counts(rest))
+  steps = np.array(data.index[x].steps, float)
+  below = lambda rows: np.concatenate([[0], np.cumsum(np.bincount(
+            np.array(ranks(data,x,rows),int), minlength=len(steps)))])
+  return npBestRank(data.cols.names[x], x, steps, below(best), below(rest))
+
+def npBestRank(name:str, x:int, steps, G, B) -> tuple:
+  "Score all step pairs at once. First best pair wins (as bestRank)."
+  A          = G + B
+  ks         = np.flatnonzero(np.diff(A) > 0)
+  sd         = stdev(np.repeat(steps[ks], np.diff(A)[ks]))
+  n, n1, n2  = A[-1], G[-1], B[-1]
+  i, j       = np.triu_indices(len(ks), 1)
+  lo, hi     = ks[i], ks[j] + 1
+  x1, x2     = steps[lo], steps[hi - 1]
+  ok         = x2 - x1 >= the.delta * sd
+  x1, x2, lo, hi = x1[ok], x2[ok], lo[ok], hi[ok]
+  left, right    = A[lo]/n < the.Dull, (n - A[hi])/n < the.Dull
+  x1, lo     = np.where(left,  -big, x1), np.where(left,  0, lo)
+  x2, hi     = np.where(right,  big, x2), np.where(right, len(steps), hi)
+  delta      = (G[hi] - G[lo])/n1 - (B[hi] - B[lo])/n2
+  best, out  = -1, None
+  if len(delta) and delta[k := int(np.argmax(delta))] > best:
+    best, out = float(delta[k]), (float(x1[k]), float(x2[k]))
+  return round(best, 3), name, x, out
+
+def npScores(rules:list, best:list, rest:list) -> Iterator[tuple]:
+  "Score all rules at once: a rule selects a row if none of its ranges fail."
+  if not rules: return
+  ranges = list(dict.fromkeys(r for rule in rules for r in rule))
+  pos    = {r:k for k,r in enumerate(ranges)}
+  uses   = np.zeros((len(rules), len(ranges)), int)
+  for n,rule in enumerate(rules): uses[n, [pos[r] for r in rule]] = 1
+  xs     = [x for _,_,x,_ in ranges]
+  lo, hi = (np.array([span[i] for *_,span in ranges], float)[:,None] 
+            for i in (0,1))
+  def fails(rows): # "?" is nan, which every range selects
+    col = {x: np.array([np.nan if (v:=row[x]) == "?" else v for row in rows],
+                       float) for x in set(xs)}
+    v   = np.array([col[x] for x in xs])
+    return (~(np.isnan(v) | ((lo <= v) & (v <= hi)))).astype(int)
+  recall = ((uses @ fails(best)) == 0).sum(1) / len(best)
+  pf     = ((uses @ fails(rest)) == 0).sum(1) / len(rest)
+  n      = recall + (1 - pf)
+  s      = 2*recall*(1-pf) / np.where(n == 0, 1, n)
+  for k,rule in enumerate(rules): yield (float(s[k]) if n[k] else 0), rule
+
+### Engines ---------------------------------------------------------
+Engines = dict(py = o(makeRange=makeRange,   scores=scores),
+               np = o(makeRange=npMakeRange, scores=npScores))
+
+def engine() -> o:
+  "Return the compute backend named in the.engine."
+  if the.engine == "np" and np is None: raise ImportError("-e np needs numpy")
+  return Engines[the.engine]
+
 ### Distance functions -----------------------------------------------
 def disty(data:Data, row:Row) -> float:
   "Best range of y values to best point."
@@ -216,6 +476,30 @@ def subsets(xs: list) -> list[list]:
   for x in xs: out += [s+[x] for s in out] + [[x]]
   return out
 
+def promising(xs: list[tuple]) -> Iterator[list]:
+  """Yield all subsets of xs, smallest first and, within a size, those with
+  most summed x[0] first (so a tight budget is not spent on long rules)."""
+  xs = sorted(xs, reverse=True)
+  for k in range(1, len(xs) + 1):
+    ks   = tuple(range(k))
+    heap = [(-sum(xs[i][0] for i in ks), ks)]
+    seen = {ks}
+    while heap:
+      s, ks = heapq.heappop(heap)
+      yield [xs[i] for i in reversed(ks)]
+      for j in range(k): # move one pick down to the next best x
+        if ks[j] + 1 < (ks[j+1] if j < k-1 else len(xs)):
+          new = ks[:j] + (ks[j] + 1,) + ks[j+1:]
+          if new not in seen:
+            seen.add(new)
+            heapq.heappush(heap, (s + xs[ks[j]][0] - xs[ks[j]+1][0], new))
+
+def ones(n:int) -> list[int]:
+  "Positions of the 1 bits in n, lowest first."
+  out = []
+  while n: out += [(n & -n).bit_length() - 1]; n &= n - 1
+  return out
+
 def chop(a:list, x:Any, inclusive=False) -> int:
   "Returns number of points <= x (if inclusive) or < x (otherwise)."
   l, r = 0, len(a)
@@ -236,7 +520,8 @@ def eg__think():
   data = Data(csv(the.file))
   for _ in range(the.repeats):
     for g,rule in sorted(think(data)):
-      print(f"{g:3f}",rule)
+      print(f"{g:3f}",decodeRule(data,rule))
+    if the.msecs or the.Evals: print(data.covered)
 
 ### Start-up --------------------------------------------------------
 the = o(**{k:coerce(v) for k,v in re.findall(r"(\w+)=(\S+)",__doc__)})
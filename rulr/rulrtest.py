@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
-import stats,sys
+import stats,sys,os,json,hashlib,multiprocessing,tempfile,shutil
 from rulr import *
 
 sys.dont_write_bytecode = True
 
+# Harness settings, on top of rulr's: -c cache=~/tmp/xper (_xper's cells)
+the.cache = os.path.expanduser("~/tmp/xper")
+
 def eg__the(): 
   print(ok := str == type(the.Delta))
   assert ok,"str not found"
@@ -54,6 +57,109 @@ def eg__fmap(r=20):
     sway2 = adds(best(distFastermap(d,d.rows,True )) for _ in range(r))
     print( *[int(x) for x in [sway1.mu, sway2.mu]])
 
+def eg__engines(seeds=10):
+  "Differential test: py and np engines give same ranges, rules, scores."
+  data = Data(csv(the.file))
+  rows = data.rows[:]
+  b4   = dict(the)
+  def think1(seed, grow):
+    the.grow = grow; random.seed(seed); data.rows = rows[:]
+    return list(think(data))
+  def run(name, seed):
+    the.engine = name
+    random.seed(seed); data.rows = rows[:]; best, rest = bestRest(data)
+    ranges = [engine().makeRange(data,x,best,rest) for x in data.cols.x]
+    return ranges, think1(seed, "subsets"), think1(seed, "beam")
+  try:
+    for seed in range(the.seed, the.seed + seeds):
+      assert run("py",seed) == run("np",seed), f"engines differ, seed={seed}"
+  finally: the.update(b4)
+  rule, best, rest = [(0,"a",0,(5,5))], [[1]], [[5]] # recall=0, pf=1
+  assert score(rule,best,rest) == next(npScores([rule],best,rest)) == (0,rule)
+  assert list(npScores([], best, rest)) == [], "np engine fails on no rules"
+
+def eg__ranks():
+  "Rank index search finds the same ranges as bestNum on binned values."
+  data = Data(csv(the.file))
+  best, rest = bestRest(data)
+  for x,i in data.index.items():
+    lo,hi = data.cols.nums[x]
+    r     = (hi-lo)/the.bins + 1e-32
+    bins  = lambda rows: [int(v/r)*r for row in rows if (v:=row[x]) != "?"]
+    want  = bestNum(data.cols.names[x], x, bins(best), bins(rest))
+    assert want == makeRange(data, x, best, rest), f"rank search differs, x={x}"
+  copies = [row[:] for row in best], [row[:] for row in rest]
+  assert [makeRange(data, x, best, rest) for x in data.index] == \
+         [makeRange(data, x, *copies)    for x in data.index], "copies differ"
+  try: ranks(data, next(iter(data.index)), [[-big]*len(data.cols.names)])
+  except KeyError: pass
+  else: assert False, "unindexed value not caught"
+
+def eg__beam():
+  "An unbounded beam over the top 8 ranges finds all their subsets."
+  data   = Data(csv(the.file))
+  best, rest = bestRest(data)
+  ranges = sorted(makeRange(data,x,best,rest) for x in data.cols.x)[-8:]
+  ranges = [r for r in ranges if r[-1]]
+  b4     = dict(the)
+  try:
+    the.Width, the.Length = 2**len(ranges), len(ranges) + 2
+    data.covered = o(evals=0, levels=0, msecs=0)
+    assert sorted(beam(engine(), data, ranges, best, rest, time.time())) == \
+           sorted(scores(subsets(ranges), best, rest)), "beam differs from subsets"
+  finally: the.update(b4)
+
+def eg__anytime():
+  """Budgeted think scores at most Evals rules; with enough, all of them. 
+  A small budget (4*Top) still finds a near-best rule."""
+  data = Data(csv(the.file))
+  rows = data.rows[:]
+  b4   = dict(the)
+  def run(evals, grow="subsets"):
+    the.Evals, the.grow = evals, grow
+    data.rows = rows[:]; random.seed(the.seed)
+    return sorted(think(data))
+  try:
+    for grow in ["subsets", "beam"]:
+      assert len(run(5,grow)) == data.covered.evals == 5, "evals not respected"
+    assert run(0) == run(2**the.Top), "anytime misses subsets"
+    assert run(4*the.Top)[-1][0] >= .9*run(0)[-1][0], "budget misses good rules"
+    the.Evals = 0; rules = think(data); next(rules); rules.close()
+    assert data.covered.msecs > 0, "coverage lost when not drained"
+  finally: the.update(b4)
+
+def eg__fires():
+  "The rule index finds the same rules as a linear scan with selects."
+  data  = Data(csv(the.file))
+  rules = [rule for _ in range(the.repeats) for _,rule in think(data)]
+  idx   = RuleIndex(rules)
+  want  = [[rule for rule in rules if selects(rule,row)] for row in data.rows]
+  assert want == [fires(idx,row) for row in data.rows], "fires differs"
+  assert want == firing(idx, data.rows), "firing differs"
+
+def eg__codes():
+  "Symbols are coded at load, and decode back to the csv's values."
+  data = Data(csv(the.file))
+  want = sorted(map(str, list(csv(the.file))[1:]))
+  assert want == sorted(str(decodeRow(data,row)) for row in data.rows)
+  assert all(type(row[x]) is int or row[x] == "?"
+             for x in data.cols.syms for row in data.rows), "uncoded symbol"
+  kid = clone(data, data.rows[:10])
+  same = lambda rows: sorted(map(str, rows))
+  assert same(kid.rows) == same(data.rows[:10]), "clone recoded symbols"
+  rules = [rule for _ in range(the.repeats) for _,rule in think(data)]
+  idx   = RuleIndex(rules)
+  raws  = [decodeRow(data,row) for row in data.rows]
+  assert [fires(idx,row) for row in data.rows] == \
+         [fires(idx,encodeRow(data,row)) for row in raws], "raw rows differ"
+  assert all(encodeRule(data, decodeRule(data,rule)) == rule for rule in rules)
+  for x in data.cols.syms:
+    row = encodeRow(data, [f"{v}?" if c == x else v 
+                           for c,v in enumerate(raws[0])])
+    assert row[x] == unseenRow, "unseen symbol got a code"
+    assert not any(selects(rule,row) for rule in rules 
+                   if x in [x1 for *_,x1,_ in rule]), "unseen symbol matched"
+
 def eg__likes():
   data = Data(csv(the.file))
   ds   = sorted(likes(data,row) for row in data.rows)
@@ -95,6 +201,7 @@ def funs(*lst):
   def all(   b, t,T):                   return so(d,T, t)
   def bore(  _, t,T): the.acq="bore"  ; return so(d,T, likely(D(t)))
   def check( b, t,T):                   return random.choices(T,k=the.Check)
+  def guess( b, t,T):                   return random.choices(t,k=b)
   def kpp(   b, t,T):                   return so(d,T, distKpp(D(t), k=b))
   def near(  _, t,T): the.acq="near"  ; return so(d,T, likely(D(t)))
   def rand(  b, t,T):                   return so(d,T, random.choices(t,k=b))
@@ -102,8 +209,8 @@ def funs(*lst):
   def sway2( _, t,T):                   return so(d,T, distFastermap(D(t), sway2=True))
   def xploit(_, t,T): the.acq="xploit"; return so(d,T, likely(D(t)))
   def xplor( _, t,T): the.acq="xplore"; return so(d,T, likely(D(t)))
-  rxs= dict(adapt=adapt, all=all, bore=bore, check=check,
-            kpp=kpp, neear=near, sway1=sway1, sway2=sway2,
+  rxs= dict(adapt=adapt, all=all, bore=bore, check=check, guess=guess,
+            kpp=kpp, near=near, sway1=sway1, sway2=sway2,
             xploit=xploit, xplor=xplor)
   return d, [f for k,f in rxs.items() if k in lst]
 
@@ -115,25 +222,64 @@ def so(data, holdout, train):
   tree = Tree(clone(data, train))
   return sorted(holdout, key=lambda row: treeLeaf(tree,row).ys.mu)[:the.Check]
 
-def _xper(data, budgets, funs, repeats=20):
-  half = len(data.rows)//2
-  b4   = adds(disty(data,row) for row in data.rows)
-  win  = lambda v: 100*(1 - (v - b4.lo)/(b4.mu - b4.lo))
-  best = lambda rows: win(disty(data, distysort(data,rows)[0]))
-  rxs,times = {},{}
-  for b in budgets:
-    the.Budget = b
-    for fun in funs:
-      key = (b, fun.__name__); rxs[key]=[]; times[key]=[]
-      for _ in range(repeats): 
-        t0          = time.time_ns()
-        data.rows   = shuffle(data.rows)
-        rxs[key]   += [best(fun(b, data.rows[:half], data.rows[half:]))]
-        times[key] += [(time.time_ns() - t0)/1_000_000]
+def _xper(data, budgets, funs, repeats=20, jobs=None, cache=None):
+  """Run budget*treatment*repeat cells on a process pool. Reuse cached cells.
+  Returns how many cells were computed (not read from the cache)."""
+  cache   = cache or the.cache
+  os.makedirs(cache, exist_ok=True)
+  with open(the.file, "rb") as f: sha = hashlib.md5(f.read()).hexdigest()
+  settings= {k:v for k,v in the.items() if k != "cache"}
+  names   = [fun.__name__ for fun in funs]
+  todo    = [(sha, dict(settings, Budget=b), rx, the.seed + r, cache)
+             for b in budgets for rx in names for r in range(repeats)]
+  rxs,times,fresh = {},{},0
+  with multiprocessing.Pool(jobs or os.cpu_count(), initializer=_load,
+                            initargs=(settings, names)) as pool:
+    for b,rx,win,msecs,new in pool.imap_unordered(_cell, todo):
+      rxs[(b,rx)]   = rxs.get((b,rx),[])   + [win]
+      times[(b,rx)] = times.get((b,rx),[]) + [msecs]
+      fresh        += new
+  _report(data, rxs, times)
+  return fresh
+
+def _load(settings, rxs):
+  "Once per worker: load the data, its treatments and its disty baseline."
+  global _worker
+  the.update(settings)
+  random.seed(the.seed) # same row order in every worker (forks reseed)
+  data, fs = funs(*rxs)
+  ys       = [disty(data,row) for row in data.rows]
+  _worker  = o(data=data, rows=data.rows[:], lo=min(ys), mu=mid(ys),
+               funs={f.__name__:f for f in fs})
+
+def _cell(todo):
+  "One experiment cell, with its own seed and settings. Cached on disk."
+  sha, settings, rx, seed, cache = todo
+  key  = json.dumps([sha, settings, rx, seed], sort_keys=True)
+  file = os.path.join(cache, hashlib.md5(key.encode()).hexdigest() + ".json")
+  new  = not os.path.exists(file)
+  if new:
+    the.update(settings); random.seed(seed)
+    w    = _worker
+    data = w.data
+    half = len(w.rows)//2
+    win  = lambda v: 100*(1 - (v - w.lo)/(w.mu - w.lo))
+    best = lambda rows: win(min(disty(data,row) for row in rows))
+    t0   = time.time_ns()
+    data.rows = shuffle(w.rows[:])
+    out  = dict(win   = best(w.funs[rx](the.Budget, data.rows[:half], data.rows[half:])),
+                msecs = (time.time_ns() - t0)/1_000_000)
+    with open(file + ".tmp", "w") as f: json.dump(out, f)
+    os.replace(file + ".tmp", file) # atomic, so interrupted runs can resume
+  with open(file) as f: out = json.load(f)
+  return settings["Budget"], rx, out["win"], out["msecs"], new
+
+def _report(data, rxs, times):
+  "Rank treatments with stats.top, then print the CSV summary row."
   keys= sorted(list(rxs.keys()))
-  scores = adds(x for lst in rxs.values() for x in lst)
-  top  = set(stats.top(rxs, reverse=True, eps=.35*scores.sd,
-                            Ks=the.Ks, Delta=the.Delta))
+  scores = sorted(x for lst in rxs.values() for x in lst)
+  top  = set(stats.top(rxs, reverse=True, eps=.35*stdev(scores),
+                       Ks=the.get("Ks", .95), Delta=the.get("Delta", "smed")))
   bang = lambda k: "!" if k in top else " "
   med  = lambda a: sum(a)/len(a)
   print("     ,    ,   ,   ",
@@ -146,14 +292,33 @@ def _xper(data, budgets, funs, repeats=20):
         *[k[0] for k in keys],
         *[k[0] for k in keys],
         "file", sep=",")
-  print(int(scores.mu), len(data.rows), len(data.cols.x), len(data.cols.y),
+  print(int(mid(scores)), len(data.rows), len(data.cols.x), len(data.cols.y),
         *[f"{int(med(rxs[k]))}{bang(k)}" for k in keys],
         *[f"{int(med(times[k]))}"  for k in keys],
         re.sub(".*/","",the.file), sep=",")
 
+def eg__xper():
+  "A rerun of _xper reads every cell from its cache. Cells are reproducible."
+  caches = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+  def wins(cache):
+    out = {}
+    for f in os.listdir(cache):
+      with open(os.path.join(cache, f)) as fp: out[f] = json.load(fp)["win"]
+    return out
+  try:
+    d, rxs = funs("guess")
+    assert _xper(d, [10,20], rxs, repeats=6, jobs=3, cache=caches[0]) == 12
+    assert _xper(d, [10,20], rxs, repeats=6, jobs=3, cache=caches[0]) == 0, \
+           "rerun recomputed cached cells"
+    assert _xper(d, [10,20], rxs, repeats=6, jobs=1, cache=caches[1]) == 12
+    assert wins(caches[0]) == wins(caches[1]), "cells differ across runs"
+  finally: [shutil.rmtree(cache) for cache in caches]
+
 def eg__all():
   for f in [eg__csv, eg__sym, eg__num, eg__data, eg__distx,
-            eg__disty, eg__irisKpp, eg__fmap,eg__tree]:
+            eg__disty, eg__irisKpp, eg__fmap,eg__tree, eg__engines,
+            eg__ranks, eg__beam, eg__anytime, eg__fires, eg__codes,
+            eg__xper]:
       print("\n"+f.__name__); f()
 
-if __name__ == "__main__": main(the, globals())
+if __name__ == "__main__": rulrMain(the, globals())